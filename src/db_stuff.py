@@ -1,64 +1,284 @@
 import asyncio
 import datetime
 import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 
-from supabase import Client as SupabaseClient
+import httpx
+from supabase import Client as SupabaseClient, ClientOptions
+
+# How long (in seconds) each DB operation is allowed to take before we give up on it.
+LATENCY_BUDGETS: dict[str, float] = {
+    "fetch_sticky_messages": 2.0,
+    "fetch_shutdowns": 2.0,
+    "post_sticky_message": 2.0,
+    "refresh_sticky_message": 1.5,
+    "delete_sticky_message": 2.0,
+    "post_shutdown": 2.0,
+    "delete_shutdown": 2.0,
+    "get_AID_from_discord_id": 2.0,
+    "fetch_players": 2.0,
+    "probe": 1.0,
+}
+DEFAULT_LATENCY_BUDGET = 2.0
+
+DB_CLIENT_TIMEOUT = 10  # seconds, hard limit on the HTTP request itself
+DB_WORKERS = 8
+
+BREAKER_FAILURE_THRESHOLD = 3  # Consecutive failures before the breaker trips
+BREAKER_PROBE_INTERVAL = 15  # seconds
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+# Errors that mean the DB is slow or unreachable, rather than that it didn't like the query
+TRANSIENT_ERRORS = (TimeoutError, CircuitOpenError, ConnectionError, httpx.TransportError)
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD):
+        self.failure_threshold = failure_threshold
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.trip_count = 0
+        self.opened_at: datetime.datetime | None = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == self.OPEN
+
+    def record_success(self):
+        self.consecutive_failures = 0
+
+    def record_failure(self) -> bool:
+        """Counts a failure, returns True if this failure tripped the breaker."""
+        self.consecutive_failures += 1
+        if self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.trip_count += 1
+            self.opened_at = datetime.datetime.now()
+            return True
+        return False
+
+    def close(self):
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
 
 
 class DBClient(SupabaseClient):
     listened_channels: list[int] = []
     stickied_messages: list = []
     shutdowns: list[dict] = []
+    players: list[dict] = []
 
     def __init__(self, console, cache_refresh_interval):
         # Setting up database connection
         url: str = os.getenv("SUPABASE_URL")
         key: str = os.getenv("SUPABASE_KEY")
-        super().__init__(url, key)
+        super().__init__(url, key, options=ClientOptions(postgrest_client_timeout=DB_CLIENT_TIMEOUT))
 
+        self._setup(console, cache_refresh_interval)
+
+    def _setup(self, console, cache_refresh_interval):
         self.console = console
         self.cache_refresh_interval = cache_refresh_interval
 
-        self.refresh_cache()
+        self.latency_budgets = dict(LATENCY_BUDGETS)
+        self.breaker = CircuitBreaker()
+        # Writes rejected while the breaker was open (or failed updates/deletes), replayed before the next refresh
+        self.pending_writes: list[tuple[str, object]] = []
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: asyncio.Task | None = None
+        # Bumped on every local sticky change, so a refresh that started before it doesn't overwrite it
+        self._sticky_version = 0
+
+        # Queries run on worker threads so we can stop waiting once the budget is spent.
+        # A query that blew its budget keeps its thread until the client timeout, so leave room for those.
+        self._executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+        # The probe gets its own worker so it never queues behind hung queries
+        self._probe_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-probe")
 
     async def start_cache_refresh(self):
+        await self.refresh_cache()
         asyncio.create_task(self.refresh_cache_task())
+        asyncio.create_task(self.breaker_probe_task())
 
     async def refresh_cache_task(self):
         print("Starting cache refresh task...")
         while True:
+            await asyncio.sleep(self.cache_refresh_interval)
             self.console.log("Refreshing cache...")
-            self.refresh_cache()
-            await asyncio.sleep(self.cache_refresh_interval)  # Refresh every 60 seconds
+            await self.refresh_cache()
 
-    def refresh_cache(self):
-        self.listened_channels = self.fetch_listened_channels()
-        self.stickied_messages = self.fetch_sticky_messages()
-        self.shutdowns = self.fetch_shutdowns()
+    async def breaker_probe_task(self):
+        while True:
+            await asyncio.sleep(BREAKER_PROBE_INTERVAL)
+            if not self.breaker.is_open:
+                continue
 
-    def fetch_sticky_messages(self):
+            if await self.probe():
+                self.breaker.close()
+                self.console.print("Database is reachable again, circuit breaker closed.", style="green")
+                await self.refresh_cache()
+
+    async def probe(self) -> bool:
         try:
-            data = self.table("sticky_messages").select("*").execute()
-            return data.data
+            await self._execute("probe", lambda: self.table("sticky_messages").select("message_id").limit(1).execute(),
+                                bypass_breaker=True, executor=self._probe_executor)
+            return True
         except Exception as e:
-            self.console.print(f"Error fetching sticky messages: {e}", style="red")
-            return []
+            self.console.print(f"Database probe failed: {e}", style="yellow")
+            return False
+
+    async def _execute(self, operation: str, query, bypass_breaker: bool = False, executor=None,
+                       track_health: bool = True):
+        """Runs a query on a worker thread. With track_health=False the caller reports to the breaker itself."""
+        if self.breaker.is_open and not bypass_breaker:
+            raise CircuitOpenError("Database circuit breaker is open")
 
-    def fetch_listened_channels(self):
+        budget = self.latency_budgets.get(operation, DEFAULT_LATENCY_BUDGET)
+        loop = asyncio.get_running_loop()
         try:
-            data = self.fetch_sticky_messages()
-            return list(set([msg["channel_id"] for msg in data]))
-        except Exception as e:
-            self.console.print(f"Error fetching listened channels: {e}", style="red")
+            result = await asyncio.wait_for(loop.run_in_executor(executor or self._executor, query), budget)
+        except asyncio.TimeoutError:
+            if track_health:
+                self._record_failure(operation)
+            raise TimeoutError(f"{operation} took longer than its {budget}s budget")
+        except TRANSIENT_ERRORS:
+            if track_health:
+                self._record_failure(operation)
+            raise
+
+        if track_health:
+            self.breaker.record_success()
+        return result
+
+    async def _write(self, operation: str, query, error_message: str, idempotent: bool):
+        """Returns the response data, [] if the write was queued for later, or None if it failed."""
+        # Anything already queued has to reach the DB first, or the writes land out of order
+        if self.pending_writes:
+            self._queue_write(operation, query)
             return []
 
-    def fetch_shutdowns(self):
         try:
-            data = self.table("shutdowns").select("*").execute()
-            return data.data
-        except Exception as e:
-            self.console.print(f"Error fetching shutdowns: {e}", style="red")
+            response = await self._execute(operation, query)
+            return response.data
+        except CircuitOpenError:
+            self._queue_write(operation, query)
+            self.console.print(f"Database is down, queued {operation} until it recovers.", style="yellow")
             return []
+        except TRANSIENT_ERRORS as e:
+            self.console.print(f"{error_message}: {e}", style="red")
+            # Safe to run an update/delete twice, so retry it later instead of losing it
+            if idempotent:
+                self._queue_write(operation, query)
+                return []
+            return None
+        except Exception as e:
+            self.console.print(f"{error_message}: {e}", style="red")
+            return None
+
+    def _queue_write(self, operation: str, query):
+        self.pending_writes.append((operation, query))
+        # While the breaker is open the probe flushes the queue once the DB is back
+        if not self.breaker.is_open and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush_pending_writes())
+
+    async def flush_pending_writes(self) -> bool:
+        # Only one replay at a time, and new writes only ever get appended, so the head is always ours to pop
+        async with self._flush_lock:
+            while self.pending_writes:
+                operation, query = self.pending_writes[0]
+                try:
+                    await self._execute(operation, query)
+                except TRANSIENT_ERRORS as e:
+                    self.console.print(f"Couldn't replay queued {operation}, will try again later: {e}",
+                                       style="yellow")
+                    return False
+                except Exception as e:
+                    # Retrying won't fix this one, and it would hold up everything behind it
+                    self.console.print(f"Dropping queued {operation}, the database rejected it: {e}", style="red")
+                self.pending_writes.pop(0)
+            return True
+
+    def _record_failure(self, operation: str):
+        if self.breaker.record_failure():
+            self.console.print(
+                f"Circuit breaker tripped after {operation} failed {self.breaker.consecutive_failures} times in a row. "
+                f"Serving from cache until the database recovers.", style="red bold")
+
+    def breaker_status(self) -> dict:
+        return {
+            "state": self.breaker.state,
+            "trip_count": self.breaker.trip_count,
+            "consecutive_failures": self.breaker.consecutive_failures,
+            "opened_at": self.breaker.opened_at,
+            "pending_writes": len(self.pending_writes),
+        }
+
+    async def refresh_cache(self):
+        if self.breaker.is_open:
+            self.console.print("Database circuit breaker is open, keeping cached data.", style="yellow")
+            return
+
+        # Otherwise the refresh would throw away changes the DB hasn't seen yet
+        if not await self.flush_pending_writes():
+            self.console.print("Keeping cached data until queued writes are saved.", style="yellow")
+            return
+
+        sticky_version = self._sticky_version
+        stickied_messages, shutdowns, players = await asyncio.gather(
+            self.fetch_sticky_messages(), self.fetch_shutdowns(), self.fetch_players(), return_exceptions=True)
+
+        # The fetches run together, so one slow moment only counts as one failure
+        if any(isinstance(result, TRANSIENT_ERRORS) for result in (stickied_messages, shutdowns, players)):
+            self._record_failure("refresh_cache")
+        else:
+            self.breaker.record_success()
+
+        if isinstance(stickied_messages, Exception):
+            self.console.print(f"Error fetching sticky messages: {stickied_messages}", style="red")
+        elif sticky_version == self._sticky_version:
+            self.stickied_messages = stickied_messages
+            self._update_listened_channels()
+
+        if isinstance(shutdowns, Exception):
+            self.console.print(f"Error fetching shutdowns: {shutdowns}", style="red")
+        else:
+            self.shutdowns = shutdowns
+
+        if isinstance(players, Exception):
+            self.console.print(f"Error fetching players: {players}", style="red")
+        else:
+            self.players = players
+
+    def _update_listened_channels(self):
+        self.listened_channels = list(set([msg["channel_id"] for msg in self.stickied_messages]))
+
+    # The fetches leave error handling (and reporting to the breaker) to refresh_cache
+    async def fetch_sticky_messages(self):
+        data = await self._execute("fetch_sticky_messages", lambda: self.table("sticky_messages").select("*").execute(),
+                                   track_health=False)
+        return data.data
+
+    async def fetch_shutdowns(self):
+        data = await self._execute("fetch_shutdowns", lambda: self.table("shutdowns").select("*").execute(),
+                                   track_health=False)
+        return data.data
+
+    async def fetch_players(self):
+        data = await self._execute("fetch_players",
+                                   lambda: self.table("players").select("discord_id, alderon_id").execute(),
+                                   track_health=False)
+        return data.data
 
     def calculate_shutdown_offset(self, birth_date: datetime.date):
         total_offset = 0
@@ -73,63 +293,166 @@ class DBClient(SupabaseClient):
 
         return total_offset
 
-    def post_sticky_message(self, message_id: int, channel_id: int, guild_id: int, content: str):
-        try:
-            data = {
-                "message_id": message_id,
-                "channel_id": channel_id,
-                "guild_id": guild_id,
-                "content": content
-            }
-            response = self.table("sticky_messages").insert(data).execute()
-            return response.data
-        except Exception as e:
-            self.console.print(f"Error posting sticky message: {e}", style="red")
-            return None
+    async def post_sticky_message(self, message_id: int, channel_id: int, guild_id: int, content: str):
+        data = {
+            "message_id": message_id,
+            "channel_id": channel_id,
+            "guild_id": guild_id,
+            "content": content
+        }
+        result = await self._write("post_sticky_message", lambda: self.table("sticky_messages").insert(data).execute(),
+                                   "Error posting sticky message", idempotent=False)
+        if result is not None:
+            self._sticky_version += 1
+            self.stickied_messages.append(dict(data))
+            self._update_listened_channels()
+        return result
 
-    def refresh_sticky_message(self, old_id: int, new_id: int):
-        try:
-            response = self.table("sticky_messages").update({"message_id": new_id}).eq("message_id", old_id).execute()
-            return response.data
-        except Exception as e:
-            self.console.print(f"Error refreshing sticky message: {e}", style="red")
-            return None
+    async def refresh_sticky_message(self, old_id: int, new_id: int):
+        result = await self._write(
+            "refresh_sticky_message",
+            lambda: self.table("sticky_messages").update({"message_id": new_id}).eq("message_id", old_id).execute(),
+            "Error refreshing sticky message", idempotent=True
+        )
+        # Keep the cache in step so sticky handling doesn't need a full refresh (or a healthy DB)
+        if result is not None:
+            self._sticky_version += 1
+            for sticky in self.stickied_messages:
+                if sticky["message_id"] == old_id:
+                    sticky["message_id"] = new_id
+        return result
 
-    def delete_sticky_message(self, message_id: int):
-        try:
-            response = self.table("sticky_messages").delete().eq("message_id", message_id).execute()
-            return response.data
-        except Exception as e:
-            self.console.print(f"Error deleting sticky message: {e}", style="red")
-            return None
+    async def delete_sticky_message(self, message_id: int):
+        result = await self._write(
+            "delete_sticky_message",
+            lambda: self.table("sticky_messages").delete().eq("message_id", message_id).execute(),
+            "Error deleting sticky message", idempotent=True
+        )
+        if result is not None:
+            self._sticky_version += 1
+            self.stickied_messages = [s for s in self.stickied_messages if s["message_id"] != message_id]
+            self._update_listened_channels()
+        return result
 
-    def post_shutdown(self, start_date: datetime.date, end_date: datetime.date, description: str):
-        try:
-            data = {
-                "start_date": start_date.isoformat(),
-                "end_date": end_date.isoformat(),
-                "description": description
-            }
-            response = self.table("shutdowns").insert(data).execute()
-            return response.data
-        except Exception as e:
-            self.console.print(f"Error posting shutdown: {e}", style="red")
-            return None
+    async def post_shutdown(self, start_date: datetime.date, end_date: datetime.date, description: str):
+        data = {
+            "start_date": start_date.isoformat(),
+            "end_date": end_date.isoformat(),
+            "description": description
+        }
+        result = await self._write("post_shutdown", lambda: self.table("shutdowns").insert(data).execute(),
+                                   "Error posting shutdown", idempotent=False)
+        # Only rows that actually made it in have an ID, queued ones show up after the next refresh
+        if result:
+            self.shutdowns.extend(result)
+        return result
 
-    def delete_shutdown(self, shutdown_id: int):
-        try:
-            response = self.table("shutdowns").delete().eg("id", shutdown_id).execute()
-            return response.data
-        except Exception as e:
-            self.console.print(f"Error deleting shutdown: {e}", style="red")
-            return None
+    async def delete_shutdown(self, shutdown_id: int):
+        result = await self._write("delete_shutdown",
+                                   lambda: self.table("shutdowns").delete().eq("id", shutdown_id).execute(),
+                                   "Error deleting shutdown", idempotent=True)
+        if result is not None:
+            self.shutdowns = [s for s in self.shutdowns if s["id"] != shutdown_id]
+        return result
 
-    def get_AID_from_discord_id(self, discord_id: int):
+    async def get_AID_from_discord_id(self, discord_id: int):
         try:
-            data = self.table("players").select("*").eq("discord_id", discord_id).execute()
+            data = await self._execute("get_AID_from_discord_id",
+                                       lambda: self.table("players").select("*").eq("discord_id", discord_id).execute())
             return data.data[0]["alderon_id"] if data.data else None
         except (ValueError, TypeError) as e:
             self.console.print(f"AID is in wrong format: {e}", style="red")
         except Exception as e:
             self.console.print(f"Error fetching AID from Discord ID: {e}", style="red")
             return None
+
+
+# ---------------------------------
+# --- Local DB Stand-in (Testing) ---
+# ---------------------------------
+class LocalQuery:
+    """Just enough of the supabase query builder for the calls DBClient makes."""
+
+    def __init__(self, db: "LocalDBClient", table_name: str):
+        self.db = db
+        self.rows: list[dict] = db.tables.setdefault(table_name, [])
+        self.action = "select"
+        self.payload = None
+        self.filters: list[tuple[str, object]] = []
+        self.row_limit: int | None = None
+
+    def select(self, *columns):
+        self.action = "select"
+        return self
+
+    def insert(self, data: dict):
+        self.action = "insert"
+        self.payload = data
+        return self
+
+    def update(self, data: dict):
+        self.action = "update"
+        self.payload = data
+        return self
+
+    def delete(self):
+        self.action = "delete"
+        return self
+
+    def eq(self, column: str, value):
+        self.filters.append((column, value))
+        return self
+
+    def limit(self, count: int):
+        self.row_limit = count
+        return self
+
+    def execute(self):
+        self.db.inject_faults()
+
+        matched = [row for row in self.rows if all(row.get(column) == value for column, value in self.filters)]
+
+        if self.action == "insert":
+            row = {"id": self.db.next_id(), **self.payload}
+            self.rows.append(row)
+            matched = [row]
+        elif self.action == "update":
+            for row in matched:
+                row.update(self.payload)
+        elif self.action == "delete":
+            for row in matched:
+                self.rows.remove(row)
+
+        if self.row_limit is not None:
+            matched = matched[:self.row_limit]
+
+        return SimpleNamespace(data=[dict(row) for row in matched])
+
+
+class LocalDBClient(DBClient):
+    """In-memory stand-in for DBClient that can be told to be slow or flaky.
+
+    Set USE_LOCAL_DB=1 to use it, and LOCAL_DB_LATENCY / LOCAL_DB_FAILURE_RATE to inject faults.
+    """
+
+    def __init__(self, console, cache_refresh_interval, latency: float = 0.0, failure_rate: float = 0.0):
+        # Not calling SupabaseClient.__init__, we never talk to a real database here
+        self.tables: dict[str, list[dict]] = {"sticky_messages": [], "shutdowns": [], "players": []}
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._last_id = 0
+
+        self._setup(console, cache_refresh_interval)
+
+    def table(self, table_name: str) -> LocalQuery:
+        return LocalQuery(self, table_name)
+
+    def next_id(self) -> int:
+        self._last_id += 1
+        return self._last_id
+
+    def inject_faults(self):
+        if self.latency:
+            time.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            raise ConnectionError("Injected database failure")
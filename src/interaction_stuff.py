@@ -0,0 +1,123 @@
+import asyncio
+import functools
+import time
+
+from discord import Interaction
+
+# Discord gives us 3 seconds to respond, so we defer a bit before that by default
+DEFAULT_RESPONSE_BUDGET = 2.0  # seconds
+
+# Per command latency records, keyed by command name
+command_latencies: dict[str, dict] = {}
+
+_auto_defers: dict[int, "AutoDefer"] = {}
+
+
+class AutoDefer:
+    """Defers the interaction if nothing has responded to it once the budget runs out."""
+
+    def __init__(self, interaction: Interaction, budget: float, ephemeral: bool):
+        self.interaction = interaction
+        self.budget = budget
+        self.ephemeral = ephemeral
+        self.deferred = False
+        self.replied = False
+        self.task = asyncio.create_task(self._defer_when_over_budget())
+
+    async def _defer_when_over_budget(self):
+        await asyncio.sleep(self.budget)
+        if self.interaction.response.is_done():
+            return
+
+        self.deferred = True
+        await self.interaction.response.defer(ephemeral=self.ephemeral, thinking=True)
+
+    async def settle(self):
+        """Stops the timer, or waits for the defer to go through if it already started."""
+        if not self.deferred:
+            self.task.cancel()
+            return
+
+        try:
+            await self.task
+        except Exception as e:
+            print(f"Error deferring interaction {self.interaction.id}: {e}")
+
+
+def deferred(budget: float = DEFAULT_RESPONSE_BUDGET, ephemeral: bool = False):
+    """Decorator for tree commands that might take a while to respond.
+
+    If the command hasn't responded within `budget` seconds it gets deferred, so reply with `respond()`
+    rather than `interaction.response.send_message()` and it'll go out as a followup when needed.
+    Goes underneath the @client.tree.command decorator.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(interaction: Interaction, *args, **kwargs):
+            start = time.perf_counter()
+            auto_defer = AutoDefer(interaction, budget, ephemeral)
+            _auto_defers[interaction.id] = auto_defer
+
+            try:
+                return await func(interaction, *args, **kwargs)
+            except Exception:
+                # Otherwise a deferred command would be stuck on "thinking..." forever
+                if not auto_defer.replied:
+                    await _send_error(interaction, auto_defer)
+                raise
+            finally:
+                await auto_defer.settle()
+                del _auto_defers[interaction.id]
+                _record_latency(interaction, budget, time.perf_counter() - start, auto_defer.deferred)
+
+        return wrapper
+
+    return decorator
+
+
+async def respond(interaction: Interaction, content: str | None = None, **kwargs):
+    """Replies to the interaction, using a followup if it was already deferred or responded to."""
+    auto_defer = _auto_defers.get(interaction.id)
+    if auto_defer is not None:
+        await auto_defer.settle()
+
+    if interaction.response.is_done():
+        result = await interaction.followup.send(content, **kwargs)
+    else:
+        result = await interaction.response.send_message(content, **kwargs)
+
+    if auto_defer is not None:
+        auto_defer.replied = True
+    return result
+
+
+async def _send_error(interaction: Interaction, auto_defer: AutoDefer):
+    await auto_defer.settle()
+    content = "Something went wrong running that command, try again later."
+    try:
+        if interaction.response.is_done():
+            # After a defer, the first followup replaces "thinking..." and keeps the defer's visibility
+            await interaction.followup.send(content, ephemeral=auto_defer.ephemeral)
+        else:
+            await interaction.response.send_message(content, ephemeral=True)
+    except Exception as e:
+        print(f"Error sending error message for interaction {interaction.id}: {e}")
+
+
+def _record_latency(interaction: Interaction, budget: float, elapsed: float, was_deferred: bool):
+    name = interaction.command.qualified_name if interaction.command else "unknown"
+    record = command_latencies.setdefault(name, {
+        "budget": budget,
+        "calls": 0,
+        "deferred": 0,
+        "max_seconds": 0.0,
+        "last_seconds": 0.0,
+    })
+
+    record["calls"] += 1
+    record["last_seconds"] = elapsed
+    record["max_seconds"] = max(record["max_seconds"], elapsed)
+    if was_deferred:
+        record["deferred"] += 1
+        print(f"/{name} went over its {budget}s response budget and was deferred (took {elapsed:.2f}s)")
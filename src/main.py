@@ -12,14 +12,17 @@ import asyncio
 from rich.console import Console
 import requests
 
-from db_stuff import DBClient
+from db_stuff import DBClient, LocalDBClient
 from ui_stuff import StickyModal, AddShutdownView
+from interaction_stuff import deferred, respond, command_latencies
 import rcon_stuff
 
 load_dotenv()
 console = Console()
 
 CACHE_REFRESH_INTERVAL = 300  # seconds
+PLAYER_SWEEP_INTERVAL = 60  # seconds
+DINO_API_TIMEOUT = 5  # seconds
 
 
 class AnthraxUtilsClient(Client):
@@ -41,6 +44,14 @@ class AnthraxUtilsClient(Client):
         # await self.tree.sync()
         console.print("Commands synced globally", style="green")
 
+        # Background tasks start here rather than in on_ready, which fires again after every reconnect
+        console.print("Starting cache refresh thread.")
+        await db_client.start_cache_refresh()
+
+        if rcon_stuff.rcon_configured():
+            console.print("Starting player sweep thread.")
+            await player_sweeper.start_sweeping()
+
     def load_configs(self):
         with open("config/lifespans.json", "r") as f:
             self.lifespans = json.load(f)
@@ -51,14 +62,23 @@ class AnthraxUtilsClient(Client):
 
 
 client = AnthraxUtilsClient()
-db_client = DBClient(console, CACHE_REFRESH_INTERVAL)
+if os.getenv("USE_LOCAL_DB"):
+    db_client = LocalDBClient(console, CACHE_REFRESH_INTERVAL, latency=float(os.getenv("LOCAL_DB_LATENCY", 0)),
+                              failure_rate=float(os.getenv("LOCAL_DB_FAILURE_RATE", 0)))
+else:
+    db_client = DBClient(console, CACHE_REFRESH_INTERVAL)
+player_sweeper = rcon_stuff.PlayerSweeper(console, db_client, PLAYER_SWEEP_INTERVAL)
+
+
+def pending_write_note() -> str:
+    if db_client.pending_writes:
+        return "\n-# The database is having trouble right now, this will be saved once it's back."
+    return ""
 
 
 @client.event
 async def on_ready():
     console.print(f"Logged in as [green]{client.user.name}[/green]", justify="center")
-    console.print("Starting cache refresh thread.")
-    await db_client.start_cache_refresh()
 
     # Validate sticky messages on startup
     console.print("Validating sticky messages...")
@@ -91,8 +111,7 @@ async def on_ready():
     if stale_stickies:
         console.print(f"[yellow]Removing {len(stale_stickies)} stale sticky messages from database...[/yellow]")
         for message_id in stale_stickies:
-            db_client.delete_sticky_message(message_id)
-        db_client.refresh_cache()
+            await db_client.delete_sticky_message(message_id)
         console.print(f"[green]✓[/green] Cleaned up stale sticky messages")
     else:
         console.print("[green]✓ All sticky messages are valid![/green]")
@@ -119,15 +138,14 @@ async def on_message(message: Message):
 
                     new_message = await message.channel.send(sticky["content"] + "\n-# This is a sticky message.")
 
-                    db_client.refresh_sticky_message(old_id, new_message.id)
-                    db_client.refresh_cache()
+                    # Updates the cache too, so no full refresh while holding the lock
+                    await db_client.refresh_sticky_message(old_id, new_message.id)
                 except discord.errors.NotFound:
                     console.print(
                         f"[yellow]Sticky message {sticky['message_id']} not found in channel {message.channel.id}. Creating new one.[/yellow]"
                     )
                     new_message = await message.channel.send(sticky["content"] + "\n-# This is a sticky message.")
-                    db_client.refresh_sticky_message(sticky["message_id"], new_message.id)
-                    db_client.refresh_cache()
+                    await db_client.refresh_sticky_message(sticky["message_id"], new_message.id)
                 except Exception as e:
                     console.print(
                         f"[red]Error handling sticky message {sticky['message_id']} in channel {message.channel.id}: {e}[/red]"
@@ -136,18 +154,47 @@ async def on_message(message: Message):
 
 
 @client.tree.command(name="refresh-cache", description="Refreshes cache of DB")
+@deferred(ephemeral=True)
 async def refresh_cache_command(interaction: Interaction):
     if not (interaction.user.guild_permissions.administrator or interaction.user.id == 767047725333086209):
-        await interaction.response.send_message("You don't have permission to use this command.", ephemeral=True)
+        await respond(interaction, "You don't have permission to use this command.", ephemeral=True)
         return
 
-    db_client.refresh_cache()
+    await db_client.refresh_cache()
 
     embed = Embed(title="Cache Refreshed", color=discord.Color.green())
     embed.add_field(name="Sticky Messages", value=len(db_client.stickied_messages), inline=False)
     embed.add_field(name="Channels", value=len(db_client.listened_channels), inline=False)
     embed.add_field(name="Shutdowns", value=len(db_client.shutdowns), inline=False)
 
+    breaker = db_client.breaker_status()
+    embed.add_field(name="Database Circuit Breaker",
+                    value=f"`{breaker['state'].title()}` | Tripped `{breaker['trip_count']}` time(s) | "
+                          f"`{breaker['pending_writes']}` queued write(s)", inline=False)
+    if breaker["state"] == "open":
+        embed.color = discord.Color.orange()
+        embed.set_footer(text="Database is unreachable, serving cached data.")
+
+    await respond(interaction, embed=embed, ephemeral=True)
+
+
+@client.tree.command(name="command-latency", description="Shows how long slow commands have been taking to respond")
+async def command_latency_command(interaction: Interaction):
+    if not (interaction.user.guild_permissions.administrator or interaction.user.id == 767047725333086209):
+        await interaction.response.send_message("You don't have permission to use this command.", ephemeral=True)
+        return
+
+    embed = Embed(title="Command Latency", color=discord.Color.greyple())
+    for name, record in command_latencies.items():
+        embed.add_field(
+            name=f"/{name}",
+            value=f"Budget: `{record['budget']}s` | Calls: `{record['calls']}` | Deferred: `{record['deferred']}`\n"
+                  f"Last: `{record['last_seconds']:.2f}s` | Max: `{record['max_seconds']:.2f}s`",
+            inline=False
+        )
+    if not command_latencies:
+        embed.description = "No budgeted commands have been run yet."
+
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 
@@ -158,6 +205,7 @@ async def refresh_cache_command(interaction: Interaction):
 @client.tree.command(name="calculate-age", description="Calculate the age of your dino, using their birthdate.")
 @app_commands.describe(day="The day the dinosaur was born", month="The month the dinosaur was born",
                        year="The year the dinosaur was born")
+@deferred(ephemeral=True)
 async def calculate_age(interaction: Interaction, day: int, month: int, year: int):
     try:
         print(f"Calculating age for {interaction.user.display_name}...")
@@ -167,7 +215,7 @@ async def calculate_age(interaction: Interaction, day: int, month: int, year: in
 
         # Check if birthdate is in the future
         if raw_difference < 0:
-            await interaction.response.send_message("Birth date cannot be in the future!", ephemeral=True)
+            await respond(interaction, "Birth date cannot be in the future!", ephemeral=True)
             return
 
         shutdown_offset = db_client.calculate_shutdown_offset(birth_date.date())
@@ -234,12 +282,12 @@ Shutdown Offset Applied `{shutdown_offset}` days(s)
 
         embed.set_footer(text="Each in-game year is 4 weeks long.")
 
-        await interaction.response.send_message(embed=embed, ephemeral=True)
+        await respond(interaction, embed=embed, ephemeral=True)
 
 
     except ValueError as e:
-        await interaction.response.send_message("Invalid date format. Please check that your inputs are actual dates!.",
-                                                ephemeral=True)
+        await respond(interaction, "Invalid date format. Please check that your inputs are actual dates!.",
+                      ephemeral=True)
         return
 
 
@@ -263,10 +311,11 @@ async def remove_shutdown_command(interaction: Interaction, shutdown_id: str):
 
     shutdown_id = int(shutdown_id)
     await interaction.response.send_message("Removing shutdown from DB")
-    db_client.delete_shutdown(shutdown_id)
-    db_client.refresh_cache()
+    if await db_client.delete_shutdown(shutdown_id) is None:
+        await interaction.edit_original_response(content="Couldn't remove the shutdown from the database, try again later.")
+        return
 
-    await interaction.edit_original_response(content="Shutdown removed!!!")
+    await interaction.edit_original_response(content="Shutdown removed!!!" + pending_write_note())
 
 
 @remove_shutdown_command.autocomplete("shutdown_id")
@@ -335,30 +384,49 @@ async def make_sticky(interaction: Interaction):
 
 
 async def create_sticky_message(content: str, interaction: Interaction):
+    # Defer first, sending the message and saving it can take longer than Discord waits for a response
+    await interaction.response.defer(ephemeral=True, thinking=True)
+
     guild_id = interaction.guild.id
     channel_id = interaction.channel.id
     sticky_msg = await interaction.channel.send(content + "\n-# This is a sticky message.")
-    db_client.post_sticky_message(sticky_msg.id, channel_id, guild_id, content)
-    db_client.refresh_cache()
+    if await db_client.post_sticky_message(sticky_msg.id, channel_id, guild_id, content) is None:
+        await sticky_msg.delete()
+        await interaction.followup.send("Couldn't save the sticky message to the database, try again later.",
+                                        ephemeral=True)
+        return
 
-    await interaction.response.send_message("Sticky message created!", ephemeral=True)
+    await interaction.followup.send("Sticky message created!" + pending_write_note(), ephemeral=True)
 
 
 @client.tree.command(name="remove-sticky", description="Removes selected sticky message from the channel.")
 @app_commands.describe(message_id="The ID of the sticky message to remove")
+@deferred(ephemeral=True)
 async def remove_sticky(interaction: Interaction, message_id: str):
     if not (interaction.user.guild_permissions.administrator or interaction.user.id == 767047725333086209):
-        await interaction.response.send_message("You don't have permission to use this command.", ephemeral=True)
+        await respond(interaction, "You don't have permission to use this command.", ephemeral=True)
         return
 
     message_id = int(message_id)
-    await interaction.response.send_message("Removing sticky message...", ephemeral=True)
-    message = await interaction.channel.fetch_message(message_id)
-    await message.delete()
-    db_client.delete_sticky_message(message_id)
-    db_client.refresh_cache()
+    # No reply until the slow stuff is done, so @deferred can defer it if it takes too long
+    # Remove it from the DB first, otherwise on_message would just post it again
+    if await db_client.delete_sticky_message(message_id) is None:
+        await respond(interaction, "Couldn't remove the sticky message from the database, try again later.",
+                      ephemeral=True)
+        return
+
+    try:
+        message = await interaction.channel.fetch_message(message_id)
+        await message.delete()
+    except discord.errors.NotFound:
+        console.print(f"[yellow]Sticky message {message_id} was already deleted from Discord.[/yellow]")
+    except discord.HTTPException as e:
+        console.print(f"[red]Error deleting sticky message {message_id}: {e}[/red]")
+        await respond(interaction, "The sticky is no longer tracked, but I couldn't delete the message itself. "
+                                   "Please delete it by hand.", ephemeral=True)
+        return
 
-    await interaction.edit_original_response(content="Sticky message removed!")
+    await respond(interaction, "Sticky message removed!" + pending_write_note(), ephemeral=True)
 
 
 @remove_sticky.autocomplete("message_id")
@@ -375,6 +443,52 @@ async def remove_sticky_autocomplete(interaction: Interaction, current: str) ->
     ]
 
 
+# -------------------------
+# --- Player Info Stuff ---
+# -------------------------
+@client.tree.command(name="player-info", description="Shows in-game info for a player, from the latest server sweep.")
+@app_commands.describe(member="The member to look up", alderon_id="The Alderon ID to look up (XXX-XXX-XXX)")
+async def player_info_command(interaction: Interaction, member: Member | None = None, alderon_id: str | None = None):
+    if not (interaction.user.guild_permissions.administrator or interaction.user.id == 767047725333086209):
+        await interaction.response.send_message("You don't have permission to use this command.", ephemeral=True)
+        return
+
+    if not rcon_stuff.rcon_configured():
+        await interaction.response.send_message("RCON isn't set up for this bot, so player info isn't available.",
+                                                ephemeral=True)
+        return
+
+    if player_sweeper.last_sweep is None:
+        await interaction.response.send_message("No player sweep has finished yet, try again in a minute.",
+                                                ephemeral=True)
+        return
+
+    if alderon_id:
+        player = player_sweeper.get_player(alderon_id.strip())
+    elif member:
+        player = player_sweeper.get_player_by_discord_id(member.id)
+    else:
+        await interaction.response.send_message("Give me a member or an Alderon ID to look up!", ephemeral=True)
+        return
+
+    if player is None:
+        await interaction.response.send_message(
+            f"That player wasn't online as of the last sweep ({discord.utils.format_dt(player_sweeper.last_sweep, 'R')}).",
+            ephemeral=True)
+        return
+
+    embed = Embed(title=f"Player Info | {player['alderon_id']}", color=discord.Color.greyple())
+    if player["discord_id"]:
+        embed.description = f"<@{player['discord_id']}>"
+    for key, value in list(player["fields"].items())[:25]:
+        embed.add_field(name=key.title(), value=value or "-", inline=True)
+    embed.set_footer(text="Snapshot taken")
+    embed.timestamp = player["fetched_at"]
+
+    await interaction.response.send_message(
+        f"As of {discord.utils.format_dt(player['fetched_at'], 'R')}", embed=embed, ephemeral=True)
+
+
 # -----------------------
 # --- Dino Fact Stuff ---
 # -----------------------
@@ -393,7 +507,7 @@ def get_dino_image_from_wikipedia(dino_name):
         "User-Agent": "AnthraxUtilsBot/1.0 (Discord Bot; stemlertho@gmail.com)"
     }
 
-    response = requests.get(search_url, params=search_params, headers=headers)
+    response = requests.get(search_url, params=search_params, headers=headers, timeout=DINO_API_TIMEOUT)
     print(response.text)
     data = response.json()
 
@@ -406,14 +520,28 @@ def get_dino_image_from_wikipedia(dino_name):
 
 
 @client.tree.command(name="dino-fact", description="Get a cool dino fact!")
+@deferred()
 async def get_dino_fact(interaction: Interaction):
-    data = requests.get("https://dinosaur-facts-api.shultzlab.com/dinosaurs/random")
-    data = data.json()
+    # requests blocks, so run it in a thread to keep the event loop (and the defer timer) going
+    try:
+        data = await asyncio.to_thread(requests.get, "https://dinosaur-facts-api.shultzlab.com/dinosaurs/random",
+                                       timeout=DINO_API_TIMEOUT)
+        data = data.json()
+    except (requests.RequestException, ValueError) as e:
+        console.print(f"[red]Error fetching dino fact: {e}[/red]")
+        # Not ephemeral, the command defers publicly so the error would show up for everyone anyway
+        await respond(interaction, "Couldn't get a dino fact right now, try again later!")
+        return
 
     embed = Embed(title=data["Name"], color=discord.Color.greyple(), description=data["Description"])
-    embed.set_image(url=get_dino_image_from_wikipedia(data["Name"]))
 
-    await interaction.response.send_message(embed=embed)
+    # The fact is still worth sending without a picture
+    try:
+        embed.set_image(url=await asyncio.to_thread(get_dino_image_from_wikipedia, data["Name"]))
+    except (requests.RequestException, ValueError, KeyError) as e:
+        console.print(f"[yellow]Error fetching dino image for {data['Name']}: {e}[/yellow]")
+
+    await respond(interaction, embed=embed)
 
 
 # == Running the bot ==
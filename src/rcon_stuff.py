@@ -1,24 +1,221 @@
-# from mcrcon import MCRcon
-# import os
-# import re
-#
-#
-# def get_player_info(alderon_id):
-#     print(alderon_id)
-#     try:
-#         with MCRcon(os.getenv('RCON_IP'), os.getenv('RCON_PASS'), port=int(os.getenv('RCON_PORT')), timeout=5) as rcon:
-#             response = rcon.command(f"/playerinfo {alderon_id}")
-#     except Exception as e:
-#         print(f"Rcon Error: {e}")
-#         return None
-#
-#     response_clean = re.sub(r"^\(playerinfo [^)]+\):\s*", "", response)
-#     print(f"Cleaned response -> {response_clean!r}")
-#     fields: dict[str, str] = {}
-#     for segment in response_clean.split(" / "):
-#         if ":" not in segment:
-#             continue
-#         key, value = map(str.strip, segment.split(":", 1))
-#         fields[key.lower()] = value.strip()
-#
-#     return fields
+import asyncio
+import datetime
+import os
+import re
+import struct
+
+RCON_TIMEOUT = 5  # seconds
+# How long to wait for more of a response from a server that doesn't echo the end marker
+RCON_IDLE_TIMEOUT = 0.5  # seconds
+
+# Source RCON packet types
+SERVERDATA_AUTH = 3
+SERVERDATA_AUTH_RESPONSE = 2
+SERVERDATA_EXECCOMMAND = 2
+SERVERDATA_RESPONSE_VALUE = 0
+
+ALDERON_ID_PATTERN = re.compile(r"\b\d{3}-\d{3}-\d{3}\b")
+
+
+def rcon_configured() -> bool:
+    return all(os.getenv(var) for var in ("RCON_IP", "RCON_PORT", "RCON_PASS"))
+
+
+async def _send_packet(writer: asyncio.StreamWriter, request_id: int, packet_type: int, body: str):
+    payload = struct.pack("<ii", request_id, packet_type) + body.encode("utf8") + b"\x00\x00"
+    writer.write(struct.pack("<i", len(payload)) + payload)
+    await writer.drain()
+
+
+async def _read_packet(reader: asyncio.StreamReader, idle_timeout: float | None = None) -> tuple[int, int, str]:
+    # Only the wait for a new packet can time out, so we never give up halfway through one
+    (length,) = struct.unpack("<i", await asyncio.wait_for(reader.readexactly(4), idle_timeout))
+    data = await reader.readexactly(length)
+    request_id, packet_type = struct.unpack("<ii", data[:8])
+    return request_id, packet_type, data[8:-2].decode("utf8", errors="replace")
+
+
+class RconConnection:
+    """One authenticated RCON connection, reused for as many commands as you like.
+
+    Not using mcrcon here, its timeout relies on SIGALRM which doesn't work off the main thread.
+    """
+
+    def __init__(self):
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        self._last_id = 0
+        # None until we know whether the server echoes the empty end marker packet
+        self.echoes_marker: bool | None = None
+
+    async def __aenter__(self):
+        await asyncio.wait_for(self._connect(), RCON_TIMEOUT)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.writer is not None:
+            self.writer.close()
+
+    def _next_id(self) -> int:
+        self._last_id += 1
+        return self._last_id
+
+    async def _connect(self):
+        self.reader, self.writer = await asyncio.open_connection(os.getenv("RCON_IP"), int(os.getenv("RCON_PORT")))
+
+        auth_id = self._next_id()
+        await _send_packet(self.writer, auth_id, SERVERDATA_AUTH, os.getenv("RCON_PASS"))
+        while True:
+            request_id, packet_type, _ = await _read_packet(self.reader)
+            if request_id == -1:
+                raise PermissionError("RCON login failed")
+            if packet_type == SERVERDATA_AUTH_RESPONSE and request_id == auth_id:
+                return
+
+    async def command(self, command: str) -> str:
+        return await asyncio.wait_for(self._command(command), RCON_TIMEOUT)
+
+    async def _command(self, command: str) -> str:
+        command_id = self._next_id()
+        marker_id = self._next_id()
+        await _send_packet(self.writer, command_id, SERVERDATA_EXECCOMMAND, command)
+        # The server answers in order, so once the echo of this empty packet shows up the response is complete
+        await _send_packet(self.writer, marker_id, SERVERDATA_RESPONSE_VALUE, "")
+
+        response = ""
+        got_reply = False
+        while True:
+            # Not every server echoes the marker, so unless we've seen this one do it,
+            # a short silence after the reply has started counts as the end of it
+            idle_timeout = RCON_IDLE_TIMEOUT if got_reply and not self.echoes_marker else None
+            try:
+                request_id, _, body = await _read_packet(self.reader, idle_timeout)
+            except asyncio.TimeoutError:
+                self.echoes_marker = False
+                return response
+
+            if request_id == marker_id:
+                self.echoes_marker = True
+                return response
+            # Anything else is leftovers from an earlier command (like a marker echo that came in late)
+            if request_id == command_id:
+                response += body
+                got_reply = True
+
+
+async def rcon_command(command: str) -> str:
+    async with RconConnection() as rcon:
+        return await rcon.command(command)
+
+
+def parse_player_info(response: str) -> dict[str, str]:
+    response_clean = re.sub(r"^\(playerinfo [^)]+\):\s*", "", response)
+    fields: dict[str, str] = {}
+    for segment in response_clean.split(" / "):
+        if ":" not in segment:
+            continue
+        key, value = map(str.strip, segment.split(":", 1))
+        fields[key.lower()] = value.strip()
+
+    return fields
+
+
+async def get_player_info(alderon_id: str, rcon: RconConnection | None = None) -> dict[str, str] | None:
+    try:
+        if rcon is None:
+            response = await rcon_command(f"/playerinfo {alderon_id}")
+        else:
+            response = await rcon.command(f"/playerinfo {alderon_id}")
+    except Exception as e:
+        print(f"Rcon Error: {e}")
+        return None
+
+    return parse_player_info(response)
+
+
+async def get_online_alderon_ids() -> list[str]:
+    response = await rcon_command("/listplayers")
+    # dict.fromkeys drops duplicates while keeping the order
+    return list(dict.fromkeys(ALDERON_ID_PATTERN.findall(response)))
+
+
+class PlayerSweeper:
+    """Keeps an in-memory snapshot of every online player's /playerinfo, keyed by Alderon ID."""
+
+    def __init__(self, console, db_client, sweep_interval: int, max_concurrency: int = 4):
+        self.console = console
+        self.db_client = db_client
+        self.sweep_interval = sweep_interval
+        self.max_concurrency = max_concurrency
+
+        self.snapshot: dict[str, dict] = {}
+        self.last_sweep: datetime.datetime | None = None
+
+    async def start_sweeping(self):
+        asyncio.create_task(self.sweep_task())
+
+    async def sweep_task(self):
+        print("Starting player sweep task...")
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                self.console.print(f"Error sweeping players: {e}", style="red")
+            await asyncio.sleep(self.sweep_interval)
+
+    async def sweep(self):
+        alderon_ids = await get_online_alderon_ids()
+        queue: asyncio.Queue[str] = asyncio.Queue()
+        for alderon_id in alderon_ids:
+            queue.put_nowait(alderon_id)
+
+        results: dict[str, dict[str, str]] = {}
+
+        async def worker():
+            # One connection per worker, shared by all of its /playerinfo commands
+            try:
+                async with RconConnection() as rcon:
+                    while not queue.empty():
+                        alderon_id = queue.get_nowait()
+                        fields = await get_player_info(alderon_id, rcon)
+                        if fields is None:
+                            # The connection is probably broken, let the other workers carry on
+                            return
+                        results[alderon_id] = fields
+            except Exception as e:
+                self.console.print(f"RCON sweep worker failed: {e}", style="red")
+
+        await asyncio.gather(*(worker() for _ in range(min(self.max_concurrency, len(alderon_ids)))))
+
+        discord_ids = {player["alderon_id"]: player["discord_id"] for player in self.db_client.players}
+        now = datetime.datetime.now(datetime.timezone.utc)
+        snapshot = {}
+
+        for alderon_id in alderon_ids:
+            if alderon_id not in results:
+                # Keep the last good entry (with its older timestamp) if this one failed
+                if alderon_id in self.snapshot:
+                    snapshot[alderon_id] = self.snapshot[alderon_id]
+                continue
+
+            snapshot[alderon_id] = {
+                "alderon_id": alderon_id,
+                "discord_id": discord_ids.get(alderon_id),
+                "fields": results[alderon_id],
+                "fetched_at": now,
+            }
+
+        self.snapshot = snapshot
+        self.last_sweep = now
+        if len(results) < len(alderon_ids):
+            self.console.print(f"Only swept {len(results)}/{len(alderon_ids)} online players.", style="yellow")
+
+    def get_player(self, alderon_id: str) -> dict | None:
+        return self.snapshot.get(alderon_id)
+
+    def get_player_by_discord_id(self, discord_id: int) -> dict | None:
+        for player in self.snapshot.values():
+            # discord_id may come back from the DB as a string
+            if player["discord_id"] is not None and str(player["discord_id"]) == str(discord_id):
+                return player
+        return None
@@ -93,8 +93,12 @@ class AddShutdownView(discord.ui.View):
             interaction.response.send_message("The start date cannot be before the end date", ephemeral=True)
             return
 
-        self.db_client.post_shutdown(self.start_date, self.end_date, self.description)
-        self.db_client.refresh_cache()
+        # Defer first, saving can take longer than Discord waits for a response
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        if await self.db_client.post_shutdown(self.start_date, self.end_date, self.description) is None:
+            await interaction.followup.send("Couldn't save the shutdown to the database, try again later.",
+                                            ephemeral=True)
+            return
 
         print(
             f"Added row to shutdown table:\n{self.start_date.strftime("%d-%m-%Y")}  |  {self.end_date.strftime("%d-%m-%Y")}  |  {self.description}")
@@ -103,7 +107,7 @@ class AddShutdownView(discord.ui.View):
         embed.add_field(name="End Date", value=self.end_date.strftime("%d-%m-%Y"))
         embed.add_field(name="Description", value=self.description)
 
-        await interaction.response.send_message(embed=embed, ephemeral=True)
+        await interaction.followup.send(embed=embed, ephemeral=True)
         original_message = await self.original_interaction.original_response()
         await original_message.delete()
 